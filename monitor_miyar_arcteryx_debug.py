@@ -2,7 +2,8 @@
 """
 混合抓取（更稳）：
 1) 尝试 /products.json 分页；
-2) 若不可用，回退抓取 /collections/all?page=N 的 HTML，解析其中的 /products/<handle>；
+2) 若不可用，回退解析 sitemap_products_*.xml（正则提取 <loc>）拿到 /products/<handle>；
+   sitemap 也不可用时，抓取 /collections/all?page=N 的 HTML 解析 handle；
 3) 对每个 handle 拉 /products/<handle>.js，做 Arc'teryx 过滤与变体级监控。
 
 通知：
@@ -16,25 +17,66 @@
 
 适配你的 workflow（每 21 分钟）
 """
-import json, os, re, time, traceback, xml.etree.ElementTree as ET
-from dataclasses import dataclass, asdict
+import atexit, copy, gzip, logging, logging.handlers, os, queue, re, sqlite3, sys, threading, time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, fields as dataclass_fields
+from datetime import datetime, timezone
+from html import unescape as html_unescape
 from typing import Dict, List, Optional, Set
 from urllib.parse import urljoin, urlparse
-import requests
+import httpx
+from lxml import etree
+try:
+    from orjson import JSONDecodeError, dumps as json_dumps, loads as json_loads
+except ImportError:
+    # PyPy 没有 orjson：退回标准库 json（由 JIT 加速），输出格式与 orjson 一致
+    import json
+    # 非法 UTF-8 的 bytes 会抛 UnicodeDecodeError 而不是 json.JSONDecodeError；两者都是 ValueError
+    JSONDecodeError = ValueError
+    json_loads = json.loads
+
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj, default=asdict, ensure_ascii=False, separators=(",", ":")).encode()
 
 BASE = "https://store.miyaradventures.com/"
 DISCORD_WEBHOOK = os.environ.get("DISCORD_WEBHOOK", "")
-SNAPSHOT_PATH = os.environ.get("SNAPSHOT_PATH", "snapshot.json")
+SNAPSHOT_PATH = os.environ.get("SNAPSHOT_PATH", "snapshot.json.gz")  # .gz 结尾 gzip 压缩；.db/.sqlite 结尾用 SQLite
 USER_AGENT = "Mozilla/5.0 (compatible; MiyarArcMonitor/1.1; +https://github.com)"
+PAGE_BATCH = 8        # /products.json 每批并发探测的页数
+MAX_PAGES = 40        # 分页安全上限
+JS_WORKERS = 20       # /products/<handle>.js 并发数
+POOL_SIZE = 32        # 连接池上限；keep-alive 与之相同，空闲连接不会被关掉重建
+RATE_PER_SEC = 10     # 对商店的全局请求速率（令牌桶，所有线程共享）
+RATE_BURST = 10       # 令牌桶容量：空闲后允许的突发请求数
+OTHER_BRAND_RECHECK_DAYS = 30  # 回退路径：确认不是 Arc'teryx 的 handle 隔多少天才重新拉 .js
+
+# 所有请求（分页 / .js / Discord）共用一个线程安全的客户端：
+# 同源请求经 HTTP/2 多路复用到同一条 TLS 连接上
+SESSION = httpx.Client(
+    http2=True,
+    headers={"User-Agent": USER_AGENT, "Accept": "*/*"},
+    limits=httpx.Limits(max_connections=POOL_SIZE, max_keepalive_connections=POOL_SIZE),
+    timeout=20.0,
+    follow_redirects=True,
+)
 
-SESSION = requests.Session()
-SESSION.headers.update({"User-Agent": USER_AGENT, "Accept": "*/*"})
+# 日志先攒在内存里，满 256 条 / 遇到 ERROR / 进程退出时才整批写到 stdout
+LOGGER = logging.getLogger("miyar")
+LOGGER.setLevel(logging.DEBUG)
+LOGGER.propagate = False
+_stdout_handler = logging.StreamHandler(sys.stdout)
+_stdout_handler.setFormatter(logging.Formatter("[%(levelname)s] %(message)s"))
+_log_buffer = logging.handlers.MemoryHandler(256, flushLevel=logging.ERROR, target=_stdout_handler)
+LOGGER.addHandler(_log_buffer)
+atexit.register(_log_buffer.flush)
 
-def log(msg: str):
-    print(f"[DEBUG] {msg}", flush=True)
+def log(msg: str, *args):
+    """%-风格参数在真正输出时才格式化。"""
+    LOGGER.debug(msg, *args)
 
 # ---------------- 数据模型 ----------------
-@dataclass
+@dataclass(slots=True)
 class VariantState:
     id: int
     title: str
@@ -46,7 +88,7 @@ class VariantState:
     available: bool
     inventory_quantity: Optional[int]
 
-@dataclass
+@dataclass(slots=True)
 class ProductState:
     handle: str
     title: str
@@ -54,21 +96,33 @@ class ProductState:
     url: str
     image: Optional[str]
     variants: Dict[str, VariantState]
+    updated_at: Optional[str] = None
 
 Snapshot = Dict[str, ProductState]
+PRODUCT_FIELDS = tuple(f.name for f in dataclass_fields(ProductState) if f.name != "variants")
+VARIANT_FIELDS = tuple(f.name for f in dataclass_fields(VariantState))
 
 # ---------------- 工具函数 ----------------
+_MONEY_CLEAN = re.compile(r"[$,\s]")
+
 def money_to_float(x) -> float:
+    # .js 里是分为单位的 int，products.json 里是 "360.00" 这样的字符串
+    if x is None:
+        return 0.0
+    t = type(x)
+    if t is int:
+        return round(x / 100.0, 2) if x > 1000 else float(x)
+    if t is float:
+        return x
+    if t is str:
+        # "360.00" 这样的干净字符串直接转，不走正则
+        try:
+            return round(float(x), 2)
+        except ValueError:
+            pass
     try:
-        if x is None:
-            return 0.0
-        if isinstance(x, (int, float)):
-            if isinstance(x, int) and x > 1000:
-                return round(x / 100.0, 2)
-            return float(x)
-        s = str(x).strip().replace("$", "").replace(",", "")
-        return round(float(s), 2)
-    except Exception:
+        return round(float(_MONEY_CLEAN.sub("", str(x))), 2) if x else 0.0
+    except ValueError:
         return 0.0
 
 def try_get(d, *keys, default=None):
@@ -84,60 +138,236 @@ def try_get(d, *keys, default=None):
             return default
     return cur
 
-def get_json(url: str, retries: int = 3, timeout: int = 20):
+# ---------------- 请求限速（令牌桶） ----------------
+class TokenBucket:
+    """线程安全的令牌桶：按 rate 个/秒补充，最多攒 burst 个；acquire() 取不到就等。"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            self._tokens -= 1
+            # 令牌透支时按欠额排队：后来者等得更久，整体速率不超过 rate
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+
+LIMITER = TokenBucket(RATE_PER_SEC, RATE_BURST)  # 所有发往商店的请求都先取令牌
+
+# ---------------- 条件请求缓存（ETag / Last-Modified） ----------------
+NOT_MODIFIED = object()  # get_json / get_text 收到 304 时的返回值
+HTTP_CACHE: Dict[str, dict] = {}  # url -> {"etag", "last_modified", ...调用方附加的数据}
+_HTTP_CACHE_SEEN: Set[str] = set()  # 本次运行用到的 url，保存时只保留这些
+
+def _conditional_headers(url: str) -> Dict[str, str]:
+    _HTTP_CACHE_SEEN.add(url)
+    c = HTTP_CACHE.get(url) or {}
+    headers = {}
+    if c.get("etag"):
+        headers["If-None-Match"] = c["etag"]
+    if c.get("last_modified"):
+        headers["If-Modified-Since"] = c["last_modified"]
+    return headers
+
+def _remember_validators(url: str, r):
+    etag, lm = r.headers.get("ETag"), r.headers.get("Last-Modified")
+    if etag or lm:
+        HTTP_CACHE[url] = {"etag": etag, "last_modified": lm}
+    else:
+        HTTP_CACHE.pop(url, None)
+
+def cache_extra(url: str, **data):
+    """给已缓存的 url 附加数据（如该页包含的 handles），304 时调用方据此复用。"""
+    entry = HTTP_CACHE.get(url)
+    if entry is not None:
+        entry.update(data)
+
+def _fetch(url: str, retries: int = 3, timeout: int = 20, cache: bool = False, kind: str = "fetch"):
+    """带重试的 GET：返回 200 的响应、NOT_MODIFIED（仅 cache=True 时）或 None。"""
+    headers = _conditional_headers(url) if cache else None
     for i in range(retries):
+        LIMITER.acquire()
         try:
-            r = SESSION.get(url, timeout=timeout)
+            r = SESSION.get(url, timeout=timeout, headers=headers)
+            if r.status_code == 304 and cache:
+                return NOT_MODIFIED
             if r.status_code == 200:
-                ct = (r.headers.get("Content-Type") or "")
-                if "json" in ct or url.endswith(".js") or url.endswith(".json"):
-                    return r.json()
-                log(f"get_json warn content-type for {url}: {ct}")
+                return r
+            log("%s %s -> HTTP %s", kind, url, r.status_code)
+            if r.status_code in (403, 404):
                 return None
-            else:
-                log(f"get_json {url} -> HTTP {r.status_code}")
-                if r.status_code in (403, 404):
-                    return None
         except Exception as e:
-            log(f"get_json exception {url}: {e}")
+            log("%s exception %s: %s", kind, url, e)
         time.sleep(1.0 * (i + 1))
     return None
 
-def get_text(url: str, retries: int = 3, timeout: int = 20) -> Optional[str]:
-    for i in range(retries):
-        try:
-            r = SESSION.get(url, timeout=timeout)
-            if r.status_code == 200:
-                return r.text
-            else:
-                log(f"get_text {url} -> HTTP {r.status_code}")
-                if r.status_code in (403, 404):
-                    return None
-        except Exception as e:
-            log(f"get_text exception {url}: {e}")
-        time.sleep(1.0 * (i + 1))
-    return None
+def get_json(url: str, retries: int = 3, timeout: int = 20, cache: bool = False):
+    r = _fetch(url, retries, timeout, cache, "get_json")
+    if r is None or r is NOT_MODIFIED:
+        return r
+    ct = (r.headers.get("Content-Type") or "")
+    if not ("json" in ct or url.endswith(".js") or url.endswith(".json")):
+        log("get_json warn content-type for %s: %s", url, ct)
+        return None
+    try:
+        data = json_loads(r.content)
+    except JSONDecodeError as e:
+        log("get_json exception %s: %s", url, e)
+        return None
+    if cache:
+        _remember_validators(url, r)
+    return data
+
+def get_text(url: str, retries: int = 3, timeout: int = 20, cache: bool = False):
+    r = _fetch(url, retries, timeout, cache, "get_text")
+    if r is None or r is NOT_MODIFIED:
+        return r
+    if cache:
+        _remember_validators(url, r)
+    return r.text
 
 # ---------------- 抓取来源 A：products.json ----------------
-def fetch_products_via_products_json(limit: int = 250) -> List[dict]:
-    out = []
+def _fetch_products_page(page: int, limit: int, prev: Snapshot):
+    """返回 (该页商品数, 其中 Arc'teryx 的原始商品, 304 时直接沿用的 handles 或 None)。
+
+    品牌过滤在这里一次完成，非 Arc'teryx 商品不会进入后续 normalize。
+    """
+    url = urljoin(BASE, f"/products.json?limit={limit}&page={page}")
+    data = get_json(url, cache=True)
+    if data is NOT_MODIFIED:
+        entry = HTTP_CACHE.get(url) or {}
+        handles = entry.get("handles") or []
+        if "count" in entry and all(h in prev for h in handles):
+            return entry["count"], [], handles
+        # 缓存与快照对不上，放弃条件请求重新拉一次
+        HTTP_CACHE.pop(url, None)
+        data = get_json(url, cache=True)
+    items = (data or {}).get("products") or []
+    arc = [
+        p for p in items
+        if p.get("handle") and is_arcteryx(p.get("title",""), p.get("vendor"), p.get("tags", []))
+    ]
+    cache_extra(url, count=len(items), handles=[p["handle"] for p in arc])
+    return len(items), arc, None
+
+def fetch_products_via_products_json(prev: Snapshot, limit: int = 250):
+    """按批并发拉取分页：每批 PAGE_BATCH 页同时请求，遇到空页/不满页即停止。
+
+    返回 (Arc'teryx 原始商品列表, 因 304 未变化而直接沿用上次状态的 handles)。
+    """
+    out, reused = [], []
     page = 1
-    while True:
-        url = urljoin(BASE, f"/products.json?limit={limit}&page={page}")
-        data = get_json(url)
-        if not data or not data.get("products"):
-            break
-        out.extend(data["products"])
-        log(f"/products.json page={page} -> {len(data['products'])} items")
-        page += 1
-        if page > 40:
-            log("Stop at page>40 safety guard")
-            break
-        time.sleep(0.4)
-    log(f"/products.json total: {len(out)}")
-    return out
+    with ThreadPoolExecutor(max_workers=PAGE_BATCH) as ex:
+        while page <= MAX_PAGES:
+            pages = list(range(page, min(page + PAGE_BATCH, MAX_PAGES + 1)))
+            results = ex.map(lambda n: _fetch_products_page(n, limit, prev), pages)
+            last = False
+            for n, (count, items, cached) in zip(pages, results):
+                if not count:
+                    last = True
+                    break
+                out.extend(items)
+                reused.extend(cached or [])
+                log("/products.json page=%s -> %s items%s", n, count, " (304 not modified)" if cached is not None else "")
+                if count < limit:
+                    last = True
+                    break
+            if last:
+                break
+            page += PAGE_BATCH
+        else:
+            log("Stop at page>%s safety guard", MAX_PAGES)
+    log("/products.json Arc'teryx: %s fetched, %s reused via 304", len(out), len(reused))
+    return out, reused
+
+# ---------------- 抓取来源 B：sitemap_products_*.xml ----------------
+# Shopify 的 sitemap 是机器生成的固定格式：直接对原始字节做正则即可；
+# <image:loc> 不会被匹配。匹配数与 <loc 出现次数对不上（CDATA 等）时整份交给下面的 lxml 解析
+LOC_RE = re.compile(rb"<loc>\s*([^<\s]+)\s*</loc>")
+
+def _regex_sitemap_locs(body: bytes) -> List[str]:
+    locs = []
+    for m in LOC_RE.finditer(body):
+        u = m.group(1).decode()
+        # ?from=..&amp;to=.. 这类查询串要还原实体（含 &#38; 这样的数字引用）
+        locs.append(html_unescape(u) if "&" in u else u)
+    return locs
 
-# ---------------- 抓取来源 B：collections/all HTML 爬取 ----------------
+_SITEMAP_PARSER = etree.XMLParser(resolve_entities=False, no_network=True)
+
+def _parse_sitemap_locs(body: bytes) -> List[str]:
+    """lxml 整份解析 sitemap，取根命名空间下的 <loc>；<image:loc> 等不会误匹配。"""
+    root = etree.fromstring(body, _SITEMAP_PARSER)
+    ns = etree.QName(root).namespace
+    tag = f"{{{ns}}}loc" if ns else "loc"
+    return [el.text.strip() for el in root.iter(tag) if el.text]
+
+def sitemap_locs(url: str, keep) -> Optional[List[str]]:
+    """条件请求 sitemap：304 时直接用上次缓存的 <loc> 列表，否则解析并缓存 keep(loc) 为真的项。
+
+    重试后仍失败返回 None（与“sitemap 里没有条目”的空列表区分）。
+    """
+    r = _fetch(url, cache=True, kind="sitemap")
+    if r is NOT_MODIFIED:
+        cached = (HTTP_CACHE.get(url) or {}).get("locs")
+        if cached is not None:
+            return cached
+        # 304 却没有缓存的列表：放弃条件请求重新拉一次
+        HTTP_CACHE.pop(url, None)
+        r = _fetch(url, cache=True, kind="sitemap")
+    if r is None or r is NOT_MODIFIED:
+        return None
+    body = r.content
+    try:
+        found = _regex_sitemap_locs(body)
+        expected = body.count(b"<loc")
+        if not found or len(found) != expected:
+            if found:
+                log("sitemap %s: regex matched %s of %s <loc>, fallback to lxml", url, len(found), expected)
+            found = _parse_sitemap_locs(body)
+    except Exception as e:
+        log("sitemap exception %s: %s", url, e)
+        return None
+    locs = [u for u in found if keep(u)]
+    _remember_validators(url, r)
+    cache_extra(url, locs=locs)
+    return locs
+
+def iter_sitemap_product_urls() -> Optional[List[str]]:
+    """索引或任一分片抓取失败返回 None：部分目录会让缺失的商品下次被当作上新。"""
+    sitemaps = sitemap_locs(urljoin(BASE, "/sitemap.xml"), lambda u: "sitemap_products_" in u)
+    if sitemaps is None:
+        return None
+    urls: List[str] = []
+    for sm in sitemaps:
+        found = sitemap_locs(sm, lambda u: "/products/" in u)
+        if found is None:
+            log("sitemap %s failed, discard sitemap source", sm)
+            return None
+        log("%s -> %s product urls", sm, len(found))
+        urls.extend(found)
+    return urls
+
+def crawl_sitemap_handles() -> List[str]:
+    urls = iter_sitemap_product_urls()
+    if urls is None:
+        return []
+    handles: Set[str] = set()
+    for u in urls:
+        parts = [p for p in urlparse(u).path.split("/") if p]
+        if len(parts) >= 2 and parts[-2].lower() == "products":
+            handles.add(parts[-1])
+    return sorted(handles)
+
+# ---------------- 抓取来源 C：collections/all HTML 爬取 ----------------
 PRODUCT_LINK_RE = re.compile(r'href=["\'](/products/[^"\']+)["\']', re.IGNORECASE)
 
 def find_product_handles_from_html(html: str) -> Set[str]:
@@ -153,33 +383,33 @@ def crawl_collections_all(max_pages: int = 50) -> List[str]:
     all_handles: Set[str] = set()
     for page in range(1, max_pages + 1):
         url = urljoin(BASE, f"/collections/all?page={page}")
-        html = get_text(url)
-        if not html:
-            log(f"/collections/all?page={page} no html, stop.")
+        html = get_text(url, cache=True)
+        if html is NOT_MODIFIED:
+            found = set((HTTP_CACHE.get(url) or {}).get("handles") or [])
+        elif not html:
+            log("/collections/all?page=%s no html, stop.", page)
             break
-        found = find_product_handles_from_html(html)
-        log(f"/collections/all?page={page} found handles: {len(found)} (unique so far {len(all_handles|found)})")
+        else:
+            found = find_product_handles_from_html(html)
+            cache_extra(url, handles=sorted(found))
+        log("/collections/all?page=%s found handles: %s (unique so far %s)", page, len(found), len(all_handles|found))
         prev_size = len(all_handles)
         all_handles |= found
         if len(all_handles) == prev_size:
             if page > 1:
                 log("no new handles on this page, stop.")
                 break
-        time.sleep(0.5)
     return sorted(all_handles)
 
 # ---------------- normalize ----------------
-def normalize_product_from_products_json(p: dict) -> Optional[ProductState]:
-    handle = p.get("handle")
-    if not handle:
-        return None
-    url = urljoin(BASE, f"/products/{handle}")
-    image = try_get(p, "images", 0, "src")
+def _normalize_variants(raw: list) -> Dict[str, VariantState]:
+    """两种来源的变体字段相同；每个字段只取一次。"""
     variants: Dict[str, VariantState] = {}
-    for v in p.get("variants", []):
-        vid = str(v.get("id"))
-        variants[vid] = VariantState(
-            id=int(v.get("id")),
+    for v in raw:
+        vid = v.get("id")
+        iq = v.get("inventory_quantity")
+        variants[str(vid)] = VariantState(
+            id=int(vid),
             title=v.get("title") or "",
             option1=v.get("option1"),
             option2=v.get("option2"),
@@ -187,11 +417,20 @@ def normalize_product_from_products_json(p: dict) -> Optional[ProductState]:
             sku=v.get("sku"),
             price=money_to_float(v.get("price")),
             available=bool(v.get("available", False)),
-            inventory_quantity=v.get("inventory_quantity") if isinstance(v.get("inventory_quantity"), int) else None,
+            inventory_quantity=iq if isinstance(iq, int) else None,
         )
+    return variants
+
+def normalize_product_from_products_json(p: dict) -> Optional[ProductState]:
+    handle = p.get("handle")
+    if not handle:
+        return None
+    url = urljoin(BASE, f"/products/{handle}")
+    image = try_get(p, "images", 0, "src")
+    variants = _normalize_variants(p.get("variants", []))
     return ProductState(
         handle=handle, title=p.get("title") or "", vendor=p.get("vendor"),
-        url=url, image=image, variants=variants
+        url=url, image=image, variants=variants, updated_at=p.get("updated_at")
     )
 
 def normalize_product_from_js(p: dict) -> Optional[ProductState]:
@@ -200,84 +439,251 @@ def normalize_product_from_js(p: dict) -> Optional[ProductState]:
         return None
     url = p.get("url") or urljoin(BASE, f"/products/{handle}")
     image = try_get(p, "images", 0)
-    variants: Dict[str, VariantState] = {}
-    for v in p.get("variants", []):
-        vid = str(v.get("id"))
-        variants[vid] = VariantState(
-            id=int(v.get("id")),
-            title=v.get("title") or "",
-            option1=v.get("option1"),
-            option2=v.get("option2"),
-            option3=v.get("option3"),
-            sku=v.get("sku"),
-            price=money_to_float(v.get("price")),
-            available=bool(v.get("available", False)),
-            inventory_quantity=v.get("inventory_quantity") if isinstance(v.get("inventory_quantity"), int) else None,
-        )
+    variants = _normalize_variants(p.get("variants", []))
     return ProductState(
         handle=handle, title=p.get("title") or "", vendor=p.get("vendor"),
         url=url, image=image, variants=variants
     )
 
 # ---------------- 识别品牌 ----------------
+_ARC_RE = re.compile(r"arc[\u2019']?teryx", re.IGNORECASE)  # arcteryx / arc'teryx / arc’teryx
+
 def is_arcteryx(title: str, vendor: Optional[str], tags=None) -> bool:
-    t, v = (title or "").lower(), (vendor or "").lower()
-    if "arc'teryx" in v or "arcteryx" in v:
-        return True
-    if "arc'teryx" in t or "arcteryx" in t:
-        return True
-    if tags and any("arcteryx" in str(tag).lower() for tag in tags):
-        return True
-    return False
+    return bool(
+        _ARC_RE.search(vendor or "")
+        or _ARC_RE.search(title or "")
+        or (tags and any(_ARC_RE.search(str(tag)) for tag in tags))
+    )
 
 # ---------------- 快照 IO ----------------
+_LOADED_HTTP_CACHE: Optional[dict] = None  # 从 SNAPSHOT_PATH 读到的 http_cache；用于判断能否跳过重写
+
+_SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    handle TEXT PRIMARY KEY, title TEXT, vendor TEXT, url TEXT, image TEXT, updated_at TEXT
+);
+CREATE TABLE IF NOT EXISTS variants (
+    vid TEXT NOT NULL, handle TEXT NOT NULL, id INTEGER, title TEXT,
+    option1 TEXT, option2 TEXT, option3 TEXT, sku TEXT,
+    price REAL, available INTEGER, inventory_quantity INTEGER,
+    PRIMARY KEY (handle, vid)
+);
+CREATE TABLE IF NOT EXISTS http_cache (url TEXT PRIMARY KEY, entry BLOB);
+"""
+
+def _is_sqlite(path: str) -> bool:
+    return path.endswith((".db", ".sqlite"))
+
+def _load_sqlite(path: str) -> Snapshot:
+    conn = sqlite3.connect(path)
+    try:
+        snap: Snapshot = {}
+        for handle, title, vendor, url, image, updated_at in conn.execute(
+            "SELECT handle, title, vendor, url, image, updated_at FROM products"
+        ):
+            snap[handle] = ProductState(
+                handle=handle, title=title, vendor=vendor, url=url, image=image,
+                variants={}, updated_at=updated_at,
+            )
+        for row in conn.execute(f"SELECT vid, handle, {', '.join(VARIANT_FIELDS)} FROM variants"):
+            v = VariantState(*row[2:])
+            v.available = bool(v.available)
+            if row[1] in snap:
+                snap[row[1]].variants[row[0]] = v
+        for url, entry in conn.execute("SELECT url, entry FROM http_cache"):
+            HTTP_CACHE[url] = json_loads(entry)
+        return snap
+    finally:
+        conn.close()
+
+def _save_sqlite(path: str, snap: Snapshot, patch: Optional[dict], http_cache: dict):
+    """单个事务内只改动有变化的行；patch=None 时整表重建。"""
+    conn = sqlite3.connect(path)
+    try:
+        conn.executescript(_SQLITE_SCHEMA)
+        with conn:
+            if patch is None:
+                conn.execute("DELETE FROM products")
+                conn.execute("DELETE FROM variants")
+                handles, removed = list(snap), []
+            else:
+                handles = patch.get("added", []) + list(patch.get("changed", {}))
+                removed = patch.get("removed", [])
+            gone = [(h,) for h in removed]
+            conn.executemany("DELETE FROM products WHERE handle = ?", gone)
+            # 变化商品的变体整组重写，顺带清掉已下架的变体
+            conn.executemany("DELETE FROM variants WHERE handle = ?", gone + [(h,) for h in handles])
+            conn.executemany(
+                "INSERT OR REPLACE INTO products VALUES (?, ?, ?, ?, ?, ?)",
+                [(p.handle, p.title, p.vendor, p.url, p.image, p.updated_at) for p in (snap[h] for h in handles)],
+            )
+            conn.executemany(
+                f"INSERT OR REPLACE INTO variants VALUES (?, ?, {', '.join('?' * len(VARIANT_FIELDS))})",
+                [(vid, h, *(getattr(v, f) for f in VARIANT_FIELDS))
+                 for h in handles for vid, v in snap[h].variants.items()],
+            )
+            if http_cache != _LOADED_HTTP_CACHE:
+                conn.execute("DELETE FROM http_cache")
+                conn.executemany(
+                    "INSERT INTO http_cache VALUES (?, ?)",
+                    [(u, json_dumps(c)) for u, c in http_cache.items()],
+                )
+        log("sqlite upsert: products=%s, removed=%s", len(handles), len(removed))
+    finally:
+        conn.close()
+
+def _read_snapshot_bytes(path: str) -> bytes:
+    if path.endswith(".gz"):
+        with gzip.open(path, "rb") as f:
+            return f.read()
+    with open(path, "rb") as f:
+        return f.read()
+
 def load_snapshot() -> Snapshot:
-    abspath = os.path.abspath(SNAPSHOT_PATH)
-    if not os.path.exists(SNAPSHOT_PATH):
-        log(f"snapshot not found at {abspath} (first run expected)")
+    path = SNAPSHOT_PATH
+    # 兼容旧版未压缩的 snapshot.json：.gz 不存在时读它
+    if not os.path.exists(path) and path.endswith(".gz") and os.path.exists(path[:-3]):
+        log("%s not found, fallback to legacy %s", path, path[:-3])
+        path = path[:-3]
+    abspath = os.path.abspath(path)
+    if not os.path.exists(path):
+        log("snapshot not found at %s (first run expected)", abspath)
         return {}
+    global _LOADED_HTTP_CACHE
     try:
-        with open(SNAPSHOT_PATH, "r", encoding="utf-8") as f:
-            raw = json.load(f)
+        if _is_sqlite(path):
+            snap = _load_sqlite(path)
+            _LOADED_HTTP_CACHE = copy.deepcopy(HTTP_CACHE)
+            log("snapshot loaded from %s with %s products, %s cached urls", abspath, len(snap), len(HTTP_CACHE))
+            return snap
+        raw = json_loads(_read_snapshot_bytes(path))
+        # v2: {"version": 2, "products": {...}, "http_cache": {...}}；旧版直接是 products
+        if raw.get("version") == 2:
+            HTTP_CACHE.update(raw.get("http_cache") or {})
+            if path == SNAPSHOT_PATH:
+                _LOADED_HTTP_CACHE = copy.deepcopy(HTTP_CACHE)
+            raw = raw["products"]
         snap: Snapshot = {}
         for handle, pdata in raw.items():
             variants = {vid: VariantState(**v) for vid, v in pdata["variants"].items()}
             snap[handle] = ProductState(
                 handle=pdata["handle"], title=pdata["title"], vendor=pdata.get("vendor"),
-                url=pdata["url"], image=pdata.get("image"), variants=variants
+                url=pdata["url"], image=pdata.get("image"), variants=variants,
+                updated_at=pdata.get("updated_at"),
             )
-        log(f"snapshot loaded from {abspath} with {len(snap)} products")
+        log("snapshot loaded from %s with %s products, %s cached urls", abspath, len(snap), len(HTTP_CACHE))
         return snap
     except Exception as e:
-        log(f"load_snapshot error: {e}\n{traceback.format_exc()}")
+        LOGGER.exception("load_snapshot error: %s", e)
         return {}
 
-def save_snapshot(snap: Snapshot):
+def _write_snapshot_bytes(path: str, data: bytes):
+    # 先写临时文件再 os.replace：中途崩溃也不会留下半截快照
+    tmp = path + ".tmp"
+    if path.endswith(".gz"):
+        # mtime=0：内容不变时压缩结果也不变，git 不会产生空提交
+        with open(tmp, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb", mtime=0) as f:
+            f.write(data)
+    else:
+        with open(tmp, "wb") as f:
+            f.write(data)
+    os.replace(tmp, path)
+
+def save_snapshot(snap: Snapshot, patch: Optional[dict] = None):
+    """patch 为本次 snapshot_patch() 结果；为空且 http_cache 也没变时跳过写入。"""
     try:
-        serializable = {
-            h: {
-                "handle": p.handle,
-                "title": p.title,
-                "vendor": p.vendor,
-                "url": p.url,
-                "image": p.image,
-                "variants": {vid: asdict(v) for vid, v in p.variants.items()},
-            }
-            for h, p in snap.items()
-        }
         abspath = os.path.abspath(SNAPSHOT_PATH)
-        log(f"writing snapshot to {abspath}")
-        with open(SNAPSHOT_PATH, "w", encoding="utf-8") as f:
-            json.dump(serializable, f, ensure_ascii=False, indent=2)
+        http_cache = {u: c for u, c in HTTP_CACHE.items() if u in _HTTP_CACHE_SEEN}
+        if _is_sqlite(SNAPSHOT_PATH):
+            # 首次运行（库里还没东西）按整表写入
+            _save_sqlite(SNAPSHOT_PATH, snap, patch if _LOADED_HTTP_CACHE is not None else None, http_cache)
+            return
+        if patch == {} and _LOADED_HTTP_CACHE is not None:
+            if http_cache == _LOADED_HTTP_CACHE:
+                log("snapshot unchanged, skip rewrite: %s", abspath)
+                return
+            # 商品没变却要重写：只应是验证器真的更新了；大量 dropped 说明有沿用的 url 没记进 _HTTP_CACHE_SEEN
+            dropped = len(_LOADED_HTTP_CACHE.keys() - http_cache.keys())
+            updated = sum(1 for u, c in http_cache.items() if _LOADED_HTTP_CACHE.get(u) != c)
+            log("products unchanged but http_cache changed (dropped=%s, new/updated=%s), rewriting", dropped, updated)
+        log("writing snapshot to %s", abspath)
+        # orjson 原生序列化 dataclass；标准库回退时经 default=asdict
+        _write_snapshot_bytes(SNAPSHOT_PATH, json_dumps(
+            {"version": 2, "products": snap, "http_cache": http_cache}
+        ))
         size = os.path.getsize(SNAPSHOT_PATH)
-        log(f"snapshot written OK: {abspath} ({size} bytes)")
+        log("snapshot written OK: %s (%s bytes)", abspath, size)
+    except Exception as e:
+        LOGGER.exception("save_snapshot error: %s", e)
+
+def snapshot_patch(old: Snapshot, new: Snapshot) -> dict:
+    """最小变更集：新增 / 删除的 handle，以及变化商品里只含变化字段的部分。
+
+    changed[h] 里：商品级字段直接给新值；variants[vid] 新增变体给整条、删除给 None、其余只给变化字段。
+    """
+    added = sorted(h for h in new if h not in old)
+    removed = sorted(h for h in old if h not in new)
+    changed: Dict[str, dict] = {}
+    for h, pnew in new.items():
+        pold = old.get(h)
+        if pold is None or pnew == pold:
+            continue
+        diff = {f: getattr(pnew, f) for f in PRODUCT_FIELDS if getattr(pnew, f) != getattr(pold, f)}
+        vdiff: Dict[str, Optional[object]] = {}
+        for vid, vnew in pnew.variants.items():
+            vold = pold.variants.get(vid)
+            if vold is None:
+                vdiff[vid] = vnew
+            elif vnew != vold:
+                vdiff[vid] = {f: getattr(vnew, f) for f in VARIANT_FIELDS if getattr(vnew, f) != getattr(vold, f)}
+        for vid in pold.variants.keys() - pnew.variants.keys():
+            vdiff[vid] = None
+        if vdiff:
+            diff["variants"] = vdiff
+        changed[h] = diff
+    patch: dict = {}
+    if added:
+        patch["added"] = added
+    if removed:
+        patch["removed"] = removed
+    if changed:
+        patch["changed"] = changed
+    return patch
+
+def delta_path(now: datetime) -> str:
+    stem = SNAPSHOT_PATH[:-3] if SNAPSHOT_PATH.endswith(".gz") else SNAPSHOT_PATH
+    stem = stem[:-5] if stem.endswith(".json") else stem
+    return f"{stem}-{now:%Y%m%d}.delta.ndjson.gz"
+
+def save_delta(patch: dict):
+    """只归档本次的最小变更集：每次运行追加一行到当日的 .delta.ndjson.gz。"""
+    if not patch:
+        log("delta empty, nothing archived")
+        return
+    now = datetime.now(timezone.utc)
+    path = delta_path(now)
+    try:
+        line = json_dumps({"ts": now.isoformat(), **patch})
+        # gzip 允许多个 member 串接，追加写即可
+        with gzip.open(path, "ab") as f:
+            f.write(line + b"\n")
+        log("delta archived to %s: added=%s, removed=%s, changed=%s", os.path.abspath(path),
+            len(patch.get("added", [])), len(patch.get("removed", [])), len(patch.get("changed", {})))
     except Exception as e:
-        log(f"save_snapshot error: {e}\n{traceback.format_exc()}")
+        LOGGER.exception("save_delta error: %s", e)
 
 # ---------------- Discord（embed，miyar 文案 + 直达链接） ----------------
-def send_embed(description: str, thumb: Optional[str]):
+EMBEDS_PER_MESSAGE = 10     # Discord 单条消息最多 10 个 embed
+EMBED_CHARS_PER_MESSAGE = 6000  # 单条消息内所有 embed 文本总长上限
+_EMBED_QUEUE: "queue.Queue[dict]" = queue.Queue()
+_worker_lock = threading.Lock()
+_worker: Optional[threading.Thread] = None
+
+def send_embed(description: str, thumb: Optional[str], fields: Optional[List[dict]] = None):
+    """只入队；后台线程合并发送，抓取 / 写快照不等 Discord。"""
     if not DISCORD_WEBHOOK:
-        log("[NO WEBHOOK] printing instead:\n" + description)
+        extra = "".join(f"\n{f['name']}：{f['value']}" for f in fields or [])
+        log("[NO WEBHOOK] printing instead:\n%s%s", description, extra)
         return
     embed = {
         "title": "🔔 通知 miyar",
@@ -286,105 +692,254 @@ def send_embed(description: str, thumb: Optional[str]):
     }
     if thumb:
         embed["thumbnail"] = {"url": thumb}
+    if fields:
+        embed["fields"] = fields
+    _start_embed_worker()
+    _EMBED_QUEUE.put(embed)
+
+def _embed_chars(embed: dict) -> int:
+    n = len(embed.get("title") or "") + len(embed.get("description") or "")
+    return n + sum(len(f["name"]) + len(f["value"]) for f in embed.get("fields") or [])
+
+def _retry_after(r) -> float:
     try:
-        r = SESSION.post(DISCORD_WEBHOOK, json={"embeds": [embed]}, timeout=20)
+        return float(json_loads(r.content).get("retry_after"))
+    except Exception:
+        return float(r.headers.get("Retry-After") or 1.0)
+
+def _post_embeds(embeds: List[dict], retries: int = 5):
+    body = json_dumps({"embeds": embeds})  # 只序列化一次，重试复用
+    for i in range(retries):
+        try:
+            r = SESSION.post(DISCORD_WEBHOOK, content=body, headers={"Content-Type": "application/json"}, timeout=20)
+        except Exception as e:
+            log("Discord error: %s", e)
+            time.sleep(1.0 * (i + 1))
+            continue
+        if r.status_code == 429:
+            wait = _retry_after(r) + 0.25
+            log("Discord 429, retry after %.2fs", wait)
+            time.sleep(wait)
+            continue
         if r.status_code >= 300:
-            log(f"Discord HTTP {r.status_code}: {r.text[:200]}")
-    except Exception as e:
-        log(f"Discord error: {e}")
+            log("Discord HTTP %s: %s", r.status_code, r.text[:200])
+            return
+        # 主动节流：当前窗口额度用完就等到重置，避免下一次直接 429
+        if r.headers.get("X-RateLimit-Remaining") == "0":
+            time.sleep(float(r.headers.get("X-RateLimit-Reset-After") or 1.0))
+        return
+    log("Discord give up after %s attempts (%s embeds dropped)", retries, len(embeds))
+
+def _embed_worker():
+    """常驻线程：每次取出当前排队的 embed，按每条消息 ≤10 个、≤6000 字符合并发送。"""
+    carry: Optional[dict] = None
+    while True:
+        first = carry if carry is not None else _EMBED_QUEUE.get()
+        carry = None
+        batch, chars = [first], _embed_chars(first)
+        while len(batch) < EMBEDS_PER_MESSAGE:
+            try:
+                nxt = _EMBED_QUEUE.get_nowait()
+            except queue.Empty:
+                break
+            if chars + _embed_chars(nxt) > EMBED_CHARS_PER_MESSAGE:
+                carry = nxt  # 放到下一条消息
+                break
+            batch.append(nxt)
+            chars += _embed_chars(nxt)
+        try:
+            _post_embeds(batch)
+        except Exception as e:
+            log("Discord worker error: %s", e)
+        finally:
+            for _ in batch:
+                _EMBED_QUEUE.task_done()
+
+def _start_embed_worker():
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = threading.Thread(target=_embed_worker, name="discord", daemon=True)
+            _worker.start()
+
+def flush_embeds():
+    """阻塞直到队列里的 embed 全部发送完毕。"""
+    _EMBED_QUEUE.join()
 
 def format_inventory(p: ProductState) -> str:
-    counts: Dict[str, int] = {}
+    counts: Counter = Counter()
     for v in p.variants.values():
-        size = v.option2 or v.option1 or "N/A"
-        qty = v.inventory_quantity if isinstance(v.inventory_quantity, int) else (1 if v.available else 0)
-        counts[size] = counts.get(size, 0) + max(0, int(qty))
+        qty = v.inventory_quantity if type(v.inventory_quantity) is int else (1 if v.available else 0)
+        # 缺货尺码也保留（显示为 0）
+        counts[v.option2 or v.option1 or "N/A"] += max(0, qty)
     return " | ".join(f"{k}:{v}" for k, v in counts.items()) or "无"
 
 def link_line(p: ProductState) -> str:
     return f"🔗 [直达链接]({p.url})"
 
+# 三种通知共用的正文模板；kind 为标题，price 为已格式化的价格文本
+DESC_TEMPLATE = (
+    "🔔 {kind} miyar\n"
+    "• 名称：{title}\n"
+    "• 货号：{sku}\n"
+    "• 颜色：{color}\n"
+    "• 价格：{price}\n"
+    "🧾 库存信息：{inventory}\n\n"
+    "{link}\n\n"
+    "（右侧商品缩略图）"
+)
+
+def _fmt_price(x: float) -> str:
+    """整数价去掉小数位（CA$ 120），其余保留两位（CA$ 99.50）。"""
+    i = int(x)
+    return f"CA$ {i}" if x == i else f"CA$ {x:.2f}"
+
+def _variant_inventory(v: VariantState) -> str:
+    qty = v.inventory_quantity if isinstance(v.inventory_quantity, int) else (1 if v.available else 0)
+    return f"{v.option2 or 'N/A'}:{qty}"
+
+def _desc(kind: str, p: ProductState, v: VariantState, price: str, inventory: str) -> str:
+    return DESC_TEMPLATE.format(
+        kind=kind, title=p.title, sku=v.sku or "未知", color=v.option1 or "未知",
+        price=price, inventory=inventory, link=link_line(p),
+    )
+
 def desc_new(p: ProductState) -> str:
     anyv = next(iter(p.variants.values()))
-    price_line = f"• 价格：CA$ {anyv.price:.0f}" if anyv.price == int(anyv.price) else f"• 价格：CA$ {anyv.price:.2f}"
-    return (
-        f"🔔 上新提醒 miyar\n"
-        f"• 名称：{p.title}\n"
-        f"• 货号：{anyv.sku or '未知'}\n"
-        f"• 颜色：{anyv.option1 or '未知'}\n"
-        f"{price_line}\n"
-        f"🧾 库存信息：{format_inventory(p)}\n\n"
-        f"{link_line(p)}\n\n"
-        "（右侧商品缩略图）"
-    )
+    return _desc("上新提醒", p, anyv, _fmt_price(anyv.price), format_inventory(p))
 
 def desc_restock(p: ProductState, v: VariantState) -> str:
-    price_line = f"• 价格：CA$ {v.price:.0f}" if v.price == int(v.price) else f"• 价格：CA$ {v.price:.2f}"
-    return (
-        f"🔔 补货提醒 miyar\n"
-        f"• 名称：{p.title}\n"
-        f"• 货号：{v.sku or '未知'}\n"
-        f"• 颜色：{v.option1 or '未知'}\n"
-        f"{price_line}\n"
-        f"🧾 库存信息：{v.option2 or 'N/A'}:{v.inventory_quantity if isinstance(v.inventory_quantity, int) else (1 if v.available else 0)}\n\n"
-        f"{link_line(p)}\n\n"
-        "（右侧商品缩略图）"
-    )
+    return _desc("补货提醒", p, v, _fmt_price(v.price), _variant_inventory(v))
 
 def desc_price_change(p: ProductState, vold: VariantState, vnew: VariantState) -> str:
-    return (
-        f"🔔 价格变化 miyar\n"
-        f"• 名称：{p.title}\n"
-        f"• 货号：{vnew.sku or '未知'}\n"
-        f"• 颜色：{vnew.option1 or '未知'}\n"
-        f"• 价格：CA$ {vold.price:.2f} → CA$ {vnew.price:.2f}\n"
-        f"🧾 库存信息：{vnew.option2 or 'N/A'}:{vnew.inventory_quantity if isinstance(vnew.inventory_quantity, int) else (1 if vnew.available else 0)}\n\n"
-        f"{link_line(p)}\n\n"
-        "（右侧商品缩略图）"
-    )
+    return _desc("价格变化", p, vnew, f"CA$ {vold.price:.2f} → CA$ {vnew.price:.2f}", _variant_inventory(vnew))
 
 # ---------------- 构建最新快照（混合抓取） ----------------
-def build_snapshot() -> Snapshot:
+def _merge_js_fields(ps: ProductState, src: ProductState):
+    ps.image = src.image or ps.image
+    for vid, v in ps.variants.items():
+        if vid in src.variants:
+            sv = src.variants[vid]
+            v.available = sv.available
+            if isinstance(sv.inventory_quantity, int):
+                v.inventory_quantity = sv.inventory_quantity
+
+def product_js_url(handle: str) -> str:
+    return urljoin(BASE, f"/products/{handle}.js")
+
+def keep_product_js_cache(handle: str):
+    """沿用上次状态、本次没拉 .js 时保留它的验证器，下次仍能发条件请求。"""
+    _HTTP_CACHE_SEEN.add(product_js_url(handle))
+
+def fetch_product_js(handle: str):
+    """条件请求 /products/<handle>.js；线程安全，供线程池并发调用。"""
+    return get_json(product_js_url(handle), cache=True)
+
+def _known_other_brand(handle: str) -> bool:
+    """该 handle 近期已确认不是 Arc'teryx：回退路径不必再拉 .js。"""
+    url = product_js_url(handle)
+    entry = HTTP_CACHE.get(url)
+    if entry and time.time() - entry.get("other_brand_at", 0) < OTHER_BRAND_RECHECK_DAYS * 86400:
+        keep_product_js_cache(handle)  # 没有发请求，也要保留这条记录
+        return True
+    return False
+
+def _mark_other_brand(handle: str):
+    url = product_js_url(handle)
+    HTTP_CACHE.setdefault(url, {})["other_brand_at"] = int(time.time())
+
+def enrich_from_js(ps: ProductState, prev: Optional[ProductState] = None):
+    """拉 /products/<handle>.js，就地补齐 ps 的 image / available / inventory_quantity。"""
+    url = product_js_url(ps.handle)
+    js = fetch_product_js(ps.handle)
+    if js is NOT_MODIFIED:
+        if prev:
+            # .js 未变：上次补齐的字段仍然有效
+            _merge_js_fields(ps, prev)
+            return
+        HTTP_CACHE.pop(url, None)
+        js = get_json(url, cache=True)
+    if not js:
+        return
+    jsn = normalize_product_from_js(js)
+    if not jsn:
+        return
+    _merge_js_fields(ps, jsn)
+
+def unchanged_since(ps: ProductState, prev: Optional[ProductState]) -> bool:
+    """updated_at 未变，且 products.json 里的变体 id / 价格 / available 与上次一致。"""
+    if not prev or not ps.updated_at or ps.updated_at != prev.updated_at:
+        return False
+    if ps.variants.keys() != prev.variants.keys():
+        return False
+    for vid, v in ps.variants.items():
+        pv = prev.variants[vid]
+        if abs(v.price - pv.price) > 1e-6 or v.available != pv.available:
+            return False
+    return True
+
+def build_snapshot(prev: Snapshot) -> Snapshot:
     snap: Snapshot = {}
 
     # A. 先试 products.json
-    products = fetch_products_via_products_json()
-    if products:
+    products, reused = fetch_products_via_products_json(prev)
+    if products or reused:
         log("Use /products.json path")
+        # 304 未变化的分页：其中的商品直接沿用上次状态
+        for h in reused:
+            snap[h] = prev[h]
+            keep_product_js_cache(h)
+        candidates: List[ProductState] = []
         for p in products:
-            if not is_arcteryx(p.get("title",""), p.get("vendor"), p.get("tags", [])):
-                continue
             ps = normalize_product_from_products_json(p)
             if not ps:
                 continue
-            # 用 .js 精准补齐 available / inventory_quantity / image
-            js = get_json(urljoin(BASE, f"/products/{ps.handle}.js"))
-            if js:
-                jsn = normalize_product_from_js(js)
-                if jsn:
-                    ps.image = jsn.image or ps.image
-                    for vid, v in ps.variants.items():
-                        if vid in jsn.variants:
-                            jsv = jsn.variants[vid]
-                            v.available = jsv.available
-                            if isinstance(jsv.inventory_quantity, int):
-                                v.inventory_quantity = jsv.inventory_quantity
+            # 未变化的商品直接沿用上次状态（含 inventory_quantity），不再拉 .js
+            if unchanged_since(ps, prev.get(ps.handle)):
+                snap[ps.handle] = prev[ps.handle]
+                keep_product_js_cache(ps.handle)
+            else:
+                candidates.append(ps)
+        log(".js enrichment: refetch=%s, skipped(unchanged)=%s", len(candidates), len(snap))
+        # 用 .js 精准补齐 available / inventory_quantity / image（并发）
+        with ThreadPoolExecutor(max_workers=JS_WORKERS) as ex:
+            list(ex.map(lambda ps: enrich_from_js(ps, prev.get(ps.handle)), candidates))
+        for ps in candidates:
             snap[ps.handle] = ps
-        log(f"Snapshot via products.json: {len(snap)}")
+        log("Snapshot via products.json: %s", len(snap))
         if snap:
             return snap
 
-    # B. 回退：爬 collections/all
-    log("Fallback to /collections/all crawl")
-    handles = crawl_collections_all(max_pages=50)
-    log(f"handles from collections/all: {len(handles)}")
+    # B. 回退：sitemap；C. 再回退：爬 collections/all
+    log("Fallback to sitemap_products_*.xml")
+    handles = crawl_sitemap_handles()
+    log("handles from sitemap: %s", len(handles))
+    if not handles:
+        log("Fallback to /collections/all crawl")
+        handles = crawl_collections_all(max_pages=50)
+        log("handles from collections/all: %s", len(handles))
+    # 只拉上次的 Arc'teryx 商品和尚未确认品牌的 handle；其他品牌的隔 OTHER_BRAND_RECHECK_DAYS 天再复查
+    candidates = [h for h in handles if h in prev or not _known_other_brand(h)]
+    log("product .js candidates: %s (known non-Arc'teryx skipped: %s)", len(candidates), len(handles) - len(candidates))
+    # 并发拉 .js（并发数即限速），结果按 handle 顺序统一处理
+    with ThreadPoolExecutor(max_workers=JS_WORKERS) as ex:
+        results = list(ex.map(fetch_product_js, candidates))
     ok, skipped = 0, 0
-    for i, h in enumerate(handles, 1):
-        js = get_json(urljoin(BASE, f"/products/{h}.js"))
+    for h, js in zip(candidates, results):
+        if js is NOT_MODIFIED:
+            # 304：上次是 Arc'teryx 就沿用，否则上次也被跳过
+            if h in prev:
+                snap[h] = prev[h]
+                ok += 1
+            else:
+                _mark_other_brand(h)
+                skipped += 1
+            continue
         if not js:
             skipped += 1
             continue
         if not is_arcteryx(js.get("title",""), js.get("vendor"), js.get("tags", [])):
+            _mark_other_brand(h)
             skipped += 1
             continue
         ps = normalize_product_from_js(js)
@@ -393,79 +948,120 @@ def build_snapshot() -> Snapshot:
             continue
         snap[ps.handle] = ps
         ok += 1
-        if i % 25 == 0:
-            log(f"handled {i}/{len(handles)} -> ok={ok}, skipped={skipped}")
-        time.sleep(0.25)
-    log(f"Snapshot via collections: ok={ok}, skipped={skipped}, total={len(snap)}")
+    log("Snapshot via fallback: ok=%s, skipped=%s, total=%s", ok, skipped, len(snap))
     return snap
 
 # ---------------- Diff & 推送 ----------------
+def variant_embed(p: ProductState, changes: dict):
+    """同一变体本次的多种变化合成一条 embed：到货优先作正文，其余变化放 fields。"""
+    v = p.variants[changes["vid"]]
+    fields: List[dict] = []
+    if "restock" in changes or "qty_up" in changes:
+        description = desc_restock(p, v)
+        if "price" in changes:
+            vold, _ = changes["price"]
+            fields.append({"name": "价格变化", "value": f"CA$ {vold.price:.2f} → CA$ {v.price:.2f}", "inline": True})
+        if "restock" in changes and "qty_up" in changes:
+            vo, vn = changes["qty_up"]
+            fields.append({"name": "库存增加", "value": f"{vo} → {vn}", "inline": True})
+    else:
+        vold, vnew = changes["price"]
+        description = desc_price_change(p, vold, vnew)
+    return description, fields
+
 def diff_and_report(old: Snapshot, new: Snapshot):
-    # 新商品
-    for handle, p in new.items():
-        if handle not in old:
-            log(f"[NEW PRODUCT] {p.title} ({handle})")
-            send_embed(desc_new(p), p.image)
+    # 先收集事件再统一发送：("new", handle) 按商品去重；变体级变化按 (handle, vid) 归并
+    events: List[tuple] = []
+    seen: Set[tuple] = set()
+    variant_changes: Dict[tuple, dict] = {}
+
+    def add(kind: str, handle: str, vid: Optional[str] = None):
+        key = (kind, handle, vid)
+        if key in seen:
+            return
+        seen.add(key)
+        events.append(key)
+
+    def add_change(handle: str, vid: str, change: str, detail=None):
+        add("variant", handle, vid)
+        variant_changes.setdefault((handle, vid), {"vid": vid})[change] = detail
 
-    # 变体新增 / 价格变化 / 仅“缺货→到货” / 库存增加
+    # 单次遍历：新商品 / 变体新增 / 价格变化 / 仅“缺货→到货” / 库存增加
     for handle, pnew in new.items():
         pold = old.get(handle)
-        if not pold:
+        if pold is None:
+            log("[NEW PRODUCT] %s (%s)", pnew.title, handle)
+            add("new", handle)
+            continue
+        # 整体相等（dataclass __eq__ 递归比较 variants）则无需逐变体比较
+        if pnew == pold:
             continue
 
-        # 新增变体 -> 作为上新
-        for vid, vnew in pnew.variants.items():
-            if vid not in pold.variants:
-                log(f"[NEW VARIANT] {pnew.title} ({handle}) vid={vid}")
-                send_embed(desc_new(pnew), pnew.image)
-
+        # 单次遍历：每个变体只查一次旧快照
+        old_v = pold.variants
         for vid, vnew in pnew.variants.items():
-            vold = pold.variants.get(vid)
-            if not vold:
+            vold = old_v.get(vid)
+            if vold is None:
+                # 新增变体 -> 作为上新（同一商品只提醒一次）
+                log("[NEW VARIANT] %s (%s) vid=%s", pnew.title, handle, vid)
+                add("new", handle)
                 continue
 
             # 价格变化
-            if abs((vnew.price or 0) - (vold.price or 0)) > 1e-6:
-                log(f"[PRICE] {pnew.title} ({handle}) {vold.price}->{vnew.price} (vid={vid})")
-                send_embed(desc_price_change(pnew, vold, vnew), pnew.image)
+            if abs(vnew.price - vold.price) > 1e-6:
+                log("[PRICE] %s (%s) %s->%s (vid=%s)", pnew.title, handle, vold.price, vnew.price, vid)
+                add_change(handle, vid, "price", (vold, vnew))
 
             # 仅“缺货→到货”
-            if (not bool(vold.available)) and bool(vnew.available):
-                log(f"[RESTOCK] {pnew.title} ({handle}) vid={vid} now available")
-                send_embed(desc_restock(pnew, vnew), pnew.image)
+            if vnew.available and not vold.available:
+                log("[RESTOCK] %s (%s) vid=%s now available", pnew.title, handle, vid)
+                add_change(handle, vid, "restock")
 
             # 库存数量增加
-            if isinstance(vnew.inventory_quantity, int) and isinstance(vold.inventory_quantity, int):
-                if vnew.inventory_quantity > vold.inventory_quantity:
-                    log(f"[QTY UP] {pnew.title} ({handle}) vid={vid} {vold.inventory_quantity}->{vnew.inventory_quantity}")
-                    send_embed(desc_restock(pnew, vnew), pnew.image)
+            vn, vo = vnew.inventory_quantity, vold.inventory_quantity
+            if type(vn) is int and type(vo) is int and vn > vo:
+                log("[QTY UP] %s (%s) vid=%s %s->%s", pnew.title, handle, vid, vo, vn)
+                add_change(handle, vid, "qty_up", (vo, vn))
+
+    for kind, handle, vid in events:
+        p = new[handle]
+        if kind == "new":
+            send_embed(desc_new(p), p.image)
+        else:
+            description, fields = variant_embed(p, variant_changes[(handle, vid)])
+            send_embed(description, p.image, fields)
+    log("events: %s unique", len(events))
 
 # ---------------- 主入口 ----------------
 def list_dir(label: str):
     try:
-        print(f"[DEBUG] {label} | CWD={os.getcwd()} | files={os.listdir('.')}")
+        log("%s | CWD=%s | files=%s", label, os.getcwd(), os.listdir("."))
     except Exception as e:
-        print(f"[DEBUG] list_dir error: {e}")
+        log("list_dir error: %s", e)
 
 def main():
-    log(f"START cwd={os.getcwd()}")
-    log(f"ENV SNAPSHOT_PATH={SNAPSHOT_PATH} -> abs={os.path.abspath(SNAPSHOT_PATH)}")
+    log("START cwd=%s", os.getcwd())
+    log("ENV SNAPSHOT_PATH=%s -> abs=%s", SNAPSHOT_PATH, os.path.abspath(SNAPSHOT_PATH))
     list_dir("BEFORE RUN")
 
     old = load_snapshot()
-    new = build_snapshot()
-    log(f"products found (new snapshot size) = {len(new)}")
+    new = build_snapshot(old)
+    log("products found (new snapshot size) = %s", len(new))
     diff_and_report(old, new)
 
-    # 一定写快照（首次必须落盘）
-    save_snapshot(new)
+    # 快照有变化（或首次运行）才整份重写
+    patch = snapshot_patch(old, new)
+    save_snapshot(new, patch)
+    save_delta(patch)
+    # 等后台线程把通知发完再退出（daemon 线程不会阻止进程结束）
+    flush_embeds()
     list_dir("AFTER SAVE")
 
-    log(f"Done. Tracked: {len(new)} products")
+    log("Done. Tracked: %s products", len(new))
 
 if __name__ == "__main__":
     try:
         main()
     except Exception as e:
-        log(f"FATAL: {e}\n{traceback.format_exc()}")
+        LOGGER.exception("FATAL: %s", e)
         raise